@@ -1,175 +1,579 @@
 import os
-import json
+import re
+import math
 import time
+import uuid
+import logging
+import sqlite3
+from collections.abc import Iterator
+from dataclasses import dataclass
+import asyncio
+import faiss
+import httpx
+import numpy as np
+import orjson
+from pathlib import Path
+from urllib.parse import urldefrag, urljoin, urlsplit, urlunsplit
 import streamlit as st
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+from selectolax.lexbor import LexborHTMLParser
+from playwright.async_api import async_playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 from langchain_ollama import OllamaLLM, OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langgraph.graph import StateGraph, END
 
 # Config & Paths
 
 BASE_URL = "https://www.occamsadvisory.com/"
-VECTORSTORE_PATH = "faiss_index"
-USER_FILE = "user_data.json"
-CHAT_FILE = "chat_history.json"
+LLM_MODEL = "phi3:3.8b-mini-4k-instruct-q4_K_M"  # phi3:mini pinned to Q4_K_M
+EMBED_MODEL = "nomic-embed-text"  # 137M params, 768-dim
+# nomic-embed-text is trained with these task prefixes on its inputs.
+EMBED_DOC_PREFIX = "search_document: "
+EMBED_QUERY_PREFIX = "search_query: "
+MAX_SCRAPE_PAGES = 40  # BASE_URL plus same-site pages linked from it
+CHUNK_SIZE = 2048  # characters, roughly 512 tokens
+CHUNK_OVERLAP = 256
+# Derived artifact names: each stage's file is named after its own settings and
+# those of the stages before it, so changing the scraper, chunking or embedding
+# config points at new files and stale artifacts are never reused.
+KNOWLEDGE_PATH = f"knowledge_{MAX_SCRAPE_PAGES}p.json"
+CHUNKS_PATH = f"chunks_{MAX_SCRAPE_PAGES}p_{CHUNK_SIZE}_{CHUNK_OVERLAP}.json"
+_EMBED_MODEL_SLUG = re.sub(r"[^\w.-]", "-", EMBED_MODEL)  # ":" is invalid on Windows
+VECTORSTORE_PATH = (
+    f"faiss_index_{_EMBED_MODEL_SLUG}_{MAX_SCRAPE_PAGES}p_{CHUNK_SIZE}_{CHUNK_OVERLAP}"
+)
+# Token budget per request: RETRIEVER_K chunks (~4 x 512) + SYSTEM_PROMPT
+# (~250) + question (~100) + NUM_PREDICT (512) = ~2.9k, inside NUM_CTX. If the
+# prompt overflows, Ollama truncates it and drops the system prompt.
+RETRIEVER_K = 4
+NUM_CTX = 4096  # the pinned 4k-context model's full window
+NUM_PREDICT = 512
+EMBED_BATCH_SIZE = 64
+FAISS_MAX_NLIST = 64
+FAISS_NPROBE = 8
+FAISS_PQ_M = 16  # sub-quantizers: each vector is stored as M codes of NBITS bits
+FAISS_PQ_NBITS = 8
+# FAISS's recommended k-means minimum (39 points per centroid); below it the
+# PQ codebooks are undertrained and the index is too small to be worth compressing.
+FAISS_PQ_MIN_TRAIN = 39 * 2 ** FAISS_PQ_NBITS
+# Vectors are unit-normalised and searched by inner product (= cosine);
+# the wrapper normalises query vectors the same way.
+FAISS_KWARGS = {
+    "normalize_L2": True,
+    "distance_strategy": DistanceStrategy.MAX_INNER_PRODUCT,
+}
+DB_PATH = "app.db"
+LEGACY_USER_FILE = "user_data.json"  # pre-SQLite stores, imported once into DB_PATH
+LEGACY_CHAT_FILE = "chat_history.json"
+LEGACY_IMPORT_VERSION = 1  # PRAGMA user_version once the legacy import has run
+
+logger = logging.getLogger(__name__)
+
+# JSON I/O (bytes in/out via orjson; no str encode/decode round trip)
+
+def read_json(path):
+    return orjson.loads(Path(path).read_bytes())
+
+
+def write_json(path, obj):
+    # Only write-once pipeline artifacts go through here, so keep them readable.
+    Path(path).write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+
 
 # STEP 1: SCRAPER
 
+SKIP_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png", ".gif", ".svg", ".webp", ".zip", ".xml")
+SELECTORS = ["div.et_pb_text_inner", "section.et_pb_section p", "h1, h2, h3"]
+MIN_TEXT_LEN = 30
+MIN_STATIC_BLOCKS = 5  # fewer matches than this means the page needs JS rendering
+MAX_CONCURRENT_PAGES = 8
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+)
+
+# Runs inside the page: select, filter and dedupe there so only the text
+# blocks (not the whole page_source) come back over CDP.
+EXTRACT_JS = """
+([selectors, minLen, url]) => {
+    const seen = new Set();
+    const blocks = [];
+    for (const sel of selectors) {
+        document.querySelectorAll(sel).forEach((el) => {
+            const text = el.innerText.trim();
+            if (text.length > minLen && !seen.has(text)) {
+                seen.add(text);
+                blocks.push({content: text, url: url});
+            }
+        });
+    }
+    return blocks;
+}
+"""
+
+
+async def _fetch_static(client, url):
+    """Fetch server-rendered HTML without a browser; returns None on failure."""
+    try:
+        resp = await client.get(url)
+        resp.raise_for_status()
+        return resp.text
+    except httpx.HTTPError:
+        return None
+
+
+async def _scrape_rendered(context, sem, url):
+    """Extract text blocks after JS has run, in a tab of the shared browser context."""
+    async with sem:
+        page = await context.new_page()
+        try:
+            await page.goto(url)
+            try:
+                await page.wait_for_selector(", ".join(SELECTORS), timeout=10_000)
+            except PlaywrightTimeoutError:
+                pass
+            await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+            try:
+                # Analytics/chat widgets can keep the network busy forever.
+                await page.wait_for_load_state("networkidle", timeout=10_000)
+            except PlaywrightTimeoutError:
+                pass
+            return await page.evaluate(EXTRACT_JS, [SELECTORS, MIN_TEXT_LEN, url])
+        finally:
+            await page.close()
+
+
+async def scrape_all(urls):
+    """Render urls in one headless Chromium, MAX_CONCURRENT_PAGES tabs at once.
+
+    Returns one block list per page that rendered; failed pages are logged and
+    skipped so one bad URL does not abort the rest.
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENT_PAGES)
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        try:
+            context = await browser.new_context(user_agent=USER_AGENT)
+            results = await asyncio.gather(
+                *(_scrape_rendered(context, sem, url) for url in urls),
+                return_exceptions=True,
+            )
+        finally:
+            await browser.close()
+
+    pages = []
+    for url, result in zip(urls, results):
+        if isinstance(result, BaseException):
+            logger.warning("Skipping %s: %s", url, result)
+        else:
+            pages.append(result)
+    return pages
+
+
+def _normalize_url(url):
+    """Canonical URL for dedupe: no fragment, lowercase host, no trailing slash ("/" for root)."""
+    parts = urlsplit(urldefrag(url)[0])
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme, parts.netloc.lower(), path, parts.query, ""))
+
+
+def _discover_urls(html):
+    """BASE_URL followed by the same-site pages it links to, up to MAX_SCRAPE_PAGES."""
+    home = _normalize_url(BASE_URL)
+    host = urlsplit(home).netloc
+    urls = [home]
+    for node in LexborHTMLParser(html).css("a[href]"):
+        href = node.attributes.get("href")
+        if not href:
+            continue
+        url = _normalize_url(urljoin(BASE_URL, href))
+        parts = urlsplit(url)
+        if (
+            parts.scheme in ("http", "https")
+            and parts.netloc == host
+            and not parts.query
+            and not parts.path.lower().endswith(SKIP_EXTENSIONS)
+            and url not in urls
+        ):
+            urls.append(url)
+            if len(urls) >= MAX_SCRAPE_PAGES:
+                break
+    return urls
+
+
+def _extract_blocks(html, url):
+    parser = LexborHTMLParser(html)
+    data, seen_text = [], set()
+    for sel in SELECTORS:
+        for node in parser.css(sel):
+            text = node.text(strip=True)
+            if text and len(text) > MIN_TEXT_LEN and text not in seen_text:
+                seen_text.add(text)
+                data.append({"content": text, "url": url})
+    return data
+
+
+async def _scrape_pages():
+    async with httpx.AsyncClient(
+        # No pool timeout: requests queued behind the connection cap just wait.
+        timeout=httpx.Timeout(10, pool=None),
+        follow_redirects=True,
+        headers={"User-Agent": USER_AGENT},
+        # Same politeness cap as the browser tabs; extra requests queue for a slot.
+        limits=httpx.Limits(max_connections=MAX_CONCURRENT_PAGES),
+    ) as client:
+        home = await _fetch_static(client, BASE_URL)
+        urls = _discover_urls(home) if home else [BASE_URL]
+        pages = [home] + await asyncio.gather(
+            *(_fetch_static(client, url) for url in urls[1:]), return_exceptions=True
+        )
+
+    blocks, js_urls = [], []
+    for url, html in zip(urls, pages):
+        page_blocks = _extract_blocks(html, url) if isinstance(html, str) else []
+        if len(page_blocks) < MIN_STATIC_BLOCKS:
+            js_urls.append(url)
+        else:
+            blocks.extend(page_blocks)
+
+    if js_urls:
+        for page_blocks in await scrape_all(js_urls):
+            blocks.extend(page_blocks)
+    return blocks
+
+
 def scrape_occams():
-    """Scrape Occams Advisory and save into knowledge.json (only if missing)."""
-    if os.path.exists("knowledge.json"):
-        return
+    """Scrape Occams Advisory into KNOWLEDGE_PATH (only if missing); return the blocks."""
+    if os.path.exists(KNOWLEDGE_PATH):
+        return read_json(KNOWLEDGE_PATH)
 
-    options = Options()
-    options.headless = True
-    driver = webdriver.Chrome(options=options)
-    driver.get(BASE_URL)
-    time.sleep(5)  # let JS load
-    driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-    time.sleep(2)
-    html = driver.page_source
-    driver.quit()
-
-    soup = BeautifulSoup(html, "html.parser")
     data, seen_text = [], set()
-    selectors = ["div.et_pb_text_inner", "section.et_pb_section p", "h1, h2, h3"]
-
-    for sel in selectors:
-        for tag in soup.select(sel):
-            text = tag.get_text(strip=True)
-            if text and len(text) > 30 and text not in seen_text:
-                seen_text.add(text)
-                data.append({"content": text, "url": BASE_URL})
+    for block in asyncio.run(_scrape_pages()):
+        # Headers/footers repeat on every page; keep the first occurrence only.
+        if block["content"] not in seen_text:
+            seen_text.add(block["content"])
+            data.append(block)
 
-    with open("knowledge.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    write_json(KNOWLEDGE_PATH, data)
+    return data
 
 
 # STEP 2: CHUNKING
 
-def make_chunks():
-    """Convert knowledge.json into chunks.json for embedding."""
-    if os.path.exists("chunks.json"):
-        return
-    with open("knowledge.json", encoding="utf-8") as f:
-        knowledge = json.load(f)
-    chunks = [entry["content"] for entry in knowledge]
-    with open("chunks.json", "w", encoding="utf-8") as f:
-        json.dump(chunks, f, indent=2, ensure_ascii=False)
+def make_chunks(knowledge):
+    """Split scraped blocks into chunks for embedding; saved to CHUNKS_PATH."""
+    # One document per page, blocks separated by blank lines so the splitter
+    # prefers to cut between blocks rather than inside them.
+    pages = {}
+    for entry in knowledge:
+        pages.setdefault(entry["url"], []).append(entry["content"])
+
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, length_function=len
+    )
+    chunks = []
+    for blocks in pages.values():
+        chunks.extend(splitter.split_text("\n\n".join(blocks)))
+    write_json(CHUNKS_PATH, chunks)
+    return chunks
 
 # STEP 3: EMBEDDINGS + VECTORSTORE
 
-def build_embeddings():
-    """Build FAISS vectorstore from chunks.json using Ollama embeddings."""
+def _build_index(vectors):
+    """IVF index: a query scans FAISS_NPROBE of ~sqrt(N) clusters, not every vector.
+
+    Vectors are product-quantized (IVFPQ) when there are enough of them to
+    train the PQ codebooks; otherwise they are stored uncompressed (IVFFlat).
+    """
+    faiss.normalize_L2(vectors)
+    n, d = vectors.shape
+    nlist = max(1, min(FAISS_MAX_NLIST, int(math.sqrt(n))))
+    quantizer = faiss.IndexFlatIP(d)
+    if d % FAISS_PQ_M == 0 and n >= FAISS_PQ_MIN_TRAIN:
+        index = faiss.IndexIVFPQ(
+            quantizer, d, nlist, FAISS_PQ_M, FAISS_PQ_NBITS, faiss.METRIC_INNER_PRODUCT
+        )
+    else:
+        index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def build_embeddings(chunk_texts):
+    """Build and save the FAISS vectorstore from chunk texts using Ollama embeddings."""
+    embeddings = get_embeddings()
+    # embed_documents sends its whole input as one /api/embed request, so
+    # each batch is a single round trip and a single fused forward pass.
+    vectors = []
+    for i in range(0, len(chunk_texts), EMBED_BATCH_SIZE):
+        batch = [EMBED_DOC_PREFIX + text for text in chunk_texts[i:i + EMBED_BATCH_SIZE]]
+        vectors.extend(embeddings.embed_documents(batch))
+    ids = [str(uuid.uuid4()) for _ in chunk_texts]
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=_build_index(np.asarray(vectors, dtype="float32")),
+        docstore=InMemoryDocstore(
+            {i: Document(page_content=text) for i, text in zip(ids, chunk_texts)}
+        ),
+        index_to_docstore_id=dict(enumerate(ids)),
+        **FAISS_KWARGS,
+    )
+    vectorstore.save_local(VECTORSTORE_PATH)
+
+
+def preprocess():
+    """Scrape -> chunk -> embed, handing each stage's output straight to the next.
+
+    The JSON files are kept for persistence/debugging; one is only read back
+    when an earlier run already produced it and later stages still need it.
+    """
     if os.path.exists(VECTORSTORE_PATH):
         return
-    with open("chunks.json", "r", encoding="utf-8") as f:
-        chunk_texts = json.load(f)
-    docs = [Document(page_content=text) for text in chunk_texts]
-    embeddings = OllamaEmbeddings(model="phi3:mini")
-    vectorstore = FAISS.from_documents(docs, embeddings)
-    vectorstore.save_local(VECTORSTORE_PATH)
+    if os.path.exists(CHUNKS_PATH):
+        chunks = read_json(CHUNKS_PATH)
+    else:
+        chunks = make_chunks(scrape_occams())
+    build_embeddings(chunks)
 
 # USER + CHAT HISTORY
 
-def load_users():
-    return json.load(open(USER_FILE)) if os.path.exists(USER_FILE) else []
+@st.cache_resource
+def get_db():
+    """One autocommit WAL connection per process, shared by all sessions."""
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        CREATE TABLE IF NOT EXISTS users (
+            email TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            phone TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chats (
+            email TEXT NOT NULL,
+            ts REAL NOT NULL,
+            user_msg TEXT NOT NULL,
+            ai_msg TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS chats_email_ts ON chats (email, ts);
+    """)
+    if conn.execute("PRAGMA user_version").fetchone()[0] < LEGACY_IMPORT_VERSION:
+        _import_legacy_json(conn)
+    return conn
+
+
+def _import_legacy_json(conn):
+    """Copy user_data.json / chat_history.json into the database, exactly once.
+
+    The import and the user_version bump commit together, so a restart never
+    re-imports (and duplicates) chat turns, whatever the legacy files held.
+    """
+    conn.execute("BEGIN IMMEDIATE")  # serialise with other processes starting up
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        # Databases created before the version marker may already hold the import.
+        populated = conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM users) OR EXISTS (SELECT 1 FROM chats)"
+        ).fetchone()[0]
+        if version < LEGACY_IMPORT_VERSION and not populated:
+            if os.path.exists(LEGACY_USER_FILE):
+                conn.executemany(
+                    "INSERT OR IGNORE INTO users (email, name, phone) VALUES (?, ?, ?)",
+                    ((u["email"], u["name"], u["phone"]) for u in read_json(LEGACY_USER_FILE)),
+                )
+            if os.path.exists(LEGACY_CHAT_FILE):
+                # The old file has no timestamps; the list index keeps turns in
+                # order and sorts them before any turn saved with time.time().
+                conn.executemany(
+                    "INSERT INTO chats (email, ts, user_msg, ai_msg) VALUES (?, ?, ?, ?)",
+                    (
+                        (email, i, turn["user"], turn["ai"])
+                        for email, history in read_json(LEGACY_CHAT_FILE).items()
+                        for i, turn in enumerate(history)
+                    ),
+                )
+        conn.execute(f"PRAGMA user_version = {LEGACY_IMPORT_VERSION}")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def add_user(user):
+    """Register user; returns False if the email is already signed up."""
+    cur = get_db().execute(
+        "INSERT OR IGNORE INTO users (email, name, phone) VALUES (?, ?, ?)",
+        (user["email"], user["name"], user["phone"]),
+    )
+    return cur.rowcount == 1
 
 
-def save_users(users):
-    json.dump(users, open(USER_FILE, "w"), indent=4)
+def get_user(user_email):
+    row = get_db().execute(
+        "SELECT name, email, phone FROM users WHERE email = ?", (user_email,)
+    ).fetchone()
+    return dict(zip(("name", "email", "phone"), row)) if row else None
 
 
 def load_chat(user_email):
-    if os.path.exists(CHAT_FILE):
-        all_history = json.load(open(CHAT_FILE))
-        return all_history.get(user_email, [])
-    return []
+    """The user's turns, oldest first."""
+    rows = get_db().execute(
+        "SELECT user_msg, ai_msg FROM chats WHERE email = ? ORDER BY ts", (user_email,)
+    ).fetchall()
+    return [{"user": user_msg, "ai": ai_msg} for user_msg, ai_msg in rows]
 
 
-def save_chat(user_email, history):
-    all_history = json.load(open(CHAT_FILE)) if os.path.exists(CHAT_FILE) else {}
-    all_history[user_email] = history
-    json.dump(all_history, open(CHAT_FILE, "w"), indent=2)
+def save_chat_turn(user_email, turn):
+    get_db().execute(
+        "INSERT INTO chats (email, ts, user_msg, ai_msg) VALUES (?, ?, ?, ?)",
+        (user_email, time.time(), turn["user"], turn["ai"]),
+    )
 
 
-# STREAMLIT APP
+# LANGGRAPH PIPELINE
+
+@dataclass(slots=True)
+class State:
+    """Graph state; nodes read attributes and return only the fields they update."""
+    question: str = ""
+    context: str | None = None
+    answer: Iterator[str] | None = None  # token stream, see output_node
+    route: str = ""
+
+
+def _pii_masker():
+    """Compiled (pattern, mapping) for the current user, cached in session_state."""
+    info = st.session_state.user_info
+    key = (info.get("name", ""), info.get("email", ""), info.get("phone", ""))
+    cached = st.session_state.get("pii_masker")
+    if cached is None or cached[0] != key:
+        mapping = {}
+        for value, placeholder in zip(key, ("[NAME]", "[EMAIL]", "[PHONE]")):
+            if value:
+                mapping.setdefault(value, placeholder)
+        # Longest first so e.g. an email wins over a name it contains.
+        alternation = "|".join(map(re.escape, sorted(mapping, key=len, reverse=True)))
+        pattern = re.compile(alternation) if mapping else None
+        cached = (key, pattern, mapping)
+        st.session_state.pii_masker = cached
+    return cached[1], cached[2]
+
+
+def mask_pii(text):
+    if "user_info" not in st.session_state:
+        return text
+    pattern, mapping = _pii_masker()
+    if pattern is None:
+        return text
+    return pattern.sub(lambda m: mapping[m.group(0)], text)
+
+
+def router_node(state: State):
+    return {"route": "RETRIEVAL"}
+
+
+@st.cache_data(max_entries=1024, show_spinner=False)
+def _retrieve(q_norm: str) -> tuple[str, ...]:
+    """Embed + search, memoised on the normalised (already PII-masked) question."""
+    retriever = get_vectorstore().as_retriever(search_kwargs={"k": RETRIEVER_K})
+    docs = retriever.invoke(EMBED_QUERY_PREFIX + q_norm)
+    return tuple(d.page_content for d in docs)
+
+
+def retrieval_node(state: State):
+    q_norm = re.sub(r"\s+", " ", mask_pii(state.question).lower().strip())
+    texts = _retrieve(q_norm)
+    return {"context": "\n".join(texts) if texts else None}
+
+
+# Constant prefix, built once: Ollama reuses the KV cache of a matching prompt
+# prefix, so only the context/question suffix needs prefill on each turn.
+SYSTEM_PROMPT = """You are an AI Assistantrepresenting Occams Advisory.
+Using the following context, provide a clear, structured answer to the user.
+When answering, speak in first-person as the company ("we", "our").
+Be friendly, professional, and concise.
+Rules:
+   -If the user greets with (eg. "hi","hello","hey"), reply with a warm greeting and suggest 
+    what they can ask about (services, careers, contact info).
+   -If the user greets + asks a real question (e.g., "Hi, I want to know about your company"), 
+    combine both: start with a greeting and then answer their question.
+   -If the user asks something unrelated to the knowledge base, reply: 
+    "❌ Sorry, I don’t know the answer based on our data."
+   - Do NOT say "based on the provided context" or similar phrases.
+   - Just answer directly like a human from the company would.
+   - Do not include any generic signatures, disclaimers, or placeholders like [Your Name] 
+     or [Your Position]
+"""
+
+
+def _stream_answer(prompt, name=None):
+    """Yield the answer as the LLM generates it, restoring [NAME] on the fly."""
+    pending = ""
+    try:
+        for token in get_llm().stream(prompt):
+            pending += token
+            if name:
+                pending = pending.replace("[NAME]", name)
+                # Hold back a trailing "[NA" that the next token may complete.
+                cut = pending.rfind("[")
+                if cut != -1 and "[NAME]".startswith(pending[cut:]):
+                    if cut:
+                        yield pending[:cut]
+                    pending = pending[cut:]
+                    continue
+            if pending:
+                yield pending
+            pending = ""
+    except Exception:
+        pending += "⚠️ AI assistant is temporarily unavailable."
+    if pending:
+        yield pending
+
+
+def output_node(state: State):
+    prompt = SYSTEM_PROMPT + mask_pii(
+        f"\nContext:\n{state.context}\nQuestion:\n{state.question}\n"
+    )
+    # A token generator: the UI consumes it with st.write_stream.
+    answer = _stream_answer(prompt, st.session_state.get("user_info", {}).get("name"))
+    return {"answer": answer}
 
-def main():
-    # --- Preprocessing ---
-    scrape_occams()
-    make_chunks()
-    build_embeddings()
 
-    # --- Load vectorstore AFTER building ---
-    embeddings = OllamaEmbeddings(model="phi3:mini")
+# CACHED RESOURCES (built once per process, shared across reruns)
+
+@st.cache_resource
+def get_embeddings():
+    return OllamaEmbeddings(model=EMBED_MODEL)
+
+
+@st.cache_resource
+def get_vectorstore():
     vectorstore = FAISS.load_local(
-        VECTORSTORE_PATH, embeddings, allow_dangerous_deserialization=True
+        VECTORSTORE_PATH,
+        get_embeddings(),
+        allow_dangerous_deserialization=True,
+        **FAISS_KWARGS,
+    )
+    vectorstore.index.nprobe = FAISS_NPROBE  # search-time knob, not persisted
+    return vectorstore
+
+
+@st.cache_resource
+def get_llm():
+    # One client shared by every session; with OLLAMA_NUM_PARALLEL set on the
+    # server, concurrent requests are batched into the same decode steps.
+    return OllamaLLM(
+        model=LLM_MODEL, num_ctx=NUM_CTX, num_predict=NUM_PREDICT, keep_alive="30m"
     )
-    retriever = vectorstore.as_retriever()
-    llm = OllamaLLM(model="phi3:mini")
-
-    # --- LangGraph pipeline ---
-    class State(dict):
-        question: str
-        context: str
-        answer: str
-
-    def mask_pii(text):
-        masked = text
-        if "user_info" in st.session_state:
-            info = st.session_state.user_info
-            masked = masked.replace(info.get("name", ""), "[NAME]")
-            masked = masked.replace(info.get("email", ""), "[EMAIL]")
-            masked = masked.replace(info.get("phone", ""), "[PHONE]")
-        return masked
-
-    def router_node(state: State):
-        state["route"] = "RETRIEVAL"
-        return state
-
-    def retrieval_node(state: State):
-        docs = retriever.invoke(mask_pii(state["question"]))
-        state["context"] = "\n".join([d.page_content for d in docs]) if docs else None
-        return state
-
-    def output_node(state: State):
-        try:
-            prompt = f"""
-            You are an AI Assistantrepresenting Occams Advisory.
-        Using the following context, provide a clear, structured answer to the user.
-        When answering, speak in first-person as the company ("we", "our").
-        Be friendly, professional, and concise.
-        Rules:
-           -If the user greets with (eg. "hi","hello","hey"), reply with a warm greeting and suggest 
-            what they can ask about (services, careers, contact info).
-           -If the user greets + asks a real question (e.g., "Hi, I want to know about your company"), 
-            combine both: start with a greeting and then answer their question.
-           -If the user asks something unrelated to the knowledge base, reply: 
-            "❌ Sorry, I don’t know the answer based on our data."
-           - Do NOT say "based on the provided context" or similar phrases.
-           - Just answer directly like a human from the company would.
-           - Do not include any generic signatures, disclaimers, or placeholders like [Your Name] 
-             or [Your Position]
-
-            Context:
-            {state['context']}
-            Question:
-            {state['question']}
-            """
-            state["answer"] = llm.invoke(mask_pii(prompt))
-        except Exception:
-            state["answer"] = "⚠️ AI assistant is temporarily unavailable."
-        if "user_info" in st.session_state:
-            state["answer"] = state["answer"].replace(
-                "[NAME]", st.session_state.user_info["name"]
-            )
-        return state
 
+
+@st.cache_resource
+def get_app():
     graph = StateGraph(State)
     graph.add_node("router", router_node)
     graph.add_node("retrieval", retrieval_node)
@@ -178,7 +582,42 @@ def main():
     graph.add_edge("router", "retrieval")
     graph.add_edge("retrieval", "output")
     graph.add_edge("output", END)
-    app = graph.compile()
+    return graph.compile()
+
+
+# STREAMLIT APP
+
+@st.fragment
+def chat_panel(app):
+    """Chat input + history. Asking a question reruns only this fragment."""
+    user_info = st.session_state.user_info
+    user_input = st.text_input("Ask a question:")
+    if user_input:
+        state = {"question": user_input}
+        result = app.invoke(state)
+        # Show tokens as they arrive, then let the history below own the turn.
+        live = st.empty()
+        with live.container():
+            st.markdown(f"**👤 User:** {user_input}")
+            answer = st.write_stream(result["answer"])
+        live.empty()
+        turn = {"user": user_input, "ai": answer}
+        st.session_state.chat_history.append(turn)
+        save_chat_turn(user_info["email"], turn)
+
+    if st.session_state.chat_history:
+        st.subheader("Chat History")
+        for chat in st.session_state.chat_history:
+            st.markdown(f"**👤 User:** {chat['user']}")
+            st.markdown(f"**🤖 AI Bot:** {chat['ai']}")
+
+
+def main():
+    # --- Preprocessing ---
+    preprocess()
+
+    # --- Load vectorstore + LangGraph pipeline AFTER building ---
+    app = get_app()
 
 
     # STREAMLIT UI
@@ -213,33 +652,29 @@ def main():
                 elif not phone.isdigit() or len(phone) < 7:
                     st.error("Please enter a valid phone number.")
                 else:
-                    users = load_users()
                     new_user = {"name": name, "email": email, "phone": phone}
 
-                    already_signed_up = any(
-                        u["name"] == new_user["name"] and 
-                        u["email"] == new_user["email"] and 
-                        u["phone"] == new_user["phone"]
-                        for u in users
-                    )
-                    
-                    if already_signed_up:
+                    if add_user(new_user):
+                        st.success("✅ Onboarding completed! You can now chat with the assistant.")
+                        history = []
+                    elif get_user(email) == new_user:
+                        # Saved history is only restored when every stored
+                        # detail matches, not on the email alone.
                         st.warning("⚠️ You have already signed up.")
+                        history = load_chat(email)
                     else:
-                        users.append(new_user)
-                        save_users(users)
-                        st.success("✅ Onboarding completed! You can now chat with the assistant.")
+                        st.error("This email is already registered with different details.")
+                        history = None
 
-                    st.session_state.onboarding_complete = True
-                    st.session_state.user_info = new_user
-                    st.session_state.chat_history = [] 
+                    if history is not None:
+                        st.session_state.onboarding_complete = True
+                        st.session_state.user_info = new_user
+                        st.session_state.chat_history = history
 
     # Signed-In User & Logout
     
     if st.session_state.onboarding_complete:
-        user_info = st.session_state.user_info
         if st.button("🚪 Logout"):
-            save_chat(user_info["email"], st.session_state.chat_history)
             st.session_state.onboarding_complete = False
             st.session_state.user_info = {}
             st.session_state.chat_history = []
@@ -247,20 +682,9 @@ def main():
             st.rerun()
 
     # Chat Input & History
-    
-    if st.session_state.onboarding_complete:
-        user_input = st.text_input("Ask a question:")
-        if user_input:
-            state = {"question": user_input}
-            result = app.invoke(state)
-            st.session_state.chat_history.append({"user": user_input, "ai": result["answer"]})
-            save_chat(user_info["email"], st.session_state.chat_history)
 
-    if st.session_state.chat_history:
-        st.subheader("Chat History")
-        for chat in st.session_state.chat_history:
-            st.markdown(f"**👤 User:** {chat['user']}")
-            st.markdown(f"**🤖 AI Bot:** {chat['ai']}")
+    if st.session_state.onboarding_complete:
+        chat_panel(app)
 
 
 if __name__ == "__main__":